@@ -1,6 +1,7 @@
 import logging
 import asyncio
 import traceback
+import functools
 import html
 from datetime import datetime, timedelta
 import openai
@@ -34,14 +35,11 @@ import config
 import database
 import openai_utils
 
-import base64
 import json
 from json import JSONEncoder
 import io
-import requests
 import emoji
 from keyboards import BotKeyboards
-from telegram import InputFile
 import pytz
 
 # setup
@@ -57,6 +55,17 @@ logger = logging.getLogger(__name__)
 user_semaphores = {}
 user_tasks = {}
 
+# шкалы оценок моделей от 0 до 5
+_SCORE_BARS = tuple('🟢' * n + '⚪️' * (5 - n) for n in range(6))
+
+# текстовые модели раскладываются по рядам клавиатуры один раз при старте
+_CLAUDE_TEXT_MODELS = tuple(
+    model_key for model_key in config.models["available_text_models"] if "claude" in model_key.lower()
+)
+_OTHER_TEXT_MODELS = tuple(
+    model_key for model_key in config.models["available_text_models"] if "claude" not in model_key.lower()
+)
+
 HELP_MESSAGE = """<b>Команды:</b>
 /new – Начать новый диалог 🆕
 /retry – Перегенерировать предыдущий запрос 🔁
@@ -190,7 +199,7 @@ async def start_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     user_id = update.message.from_user.id
 
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.update_last_interaction(user_id)
 
     try:
         db.start_new_dialog(user_id)
@@ -226,14 +235,14 @@ async def start_handle(update: Update, context: CallbackContext):
 async def help_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.update_last_interaction(user_id)
     await update.message.reply_text(HELP_MESSAGE, parse_mode=ParseMode.HTML)
 
 
 async def help_group_chat_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.update_last_interaction(user_id)
 
     text = HELP_GROUP_CHAT_MESSAGE.format(bot_username="@" + context.bot.username)
     await update.message.reply_text(text, parse_mode=ParseMode.HTML)
@@ -249,7 +258,7 @@ async def process_successful_payment(payment_info, user_id):
         is_donation = metadata.get('is_donation', 'false') == 'true'
         subscription_type = metadata.get('subscription_type')
 
-        logger.info(f"Processing successful payment {payment_info.id} for user {user_id}, amount: {amount} RUB")
+        logger.info("Processing successful payment %s for user %s, amount: %s RUB", payment_info.id, user_id, amount)
 
         if subscription_type:
             subscription_type_enum = SubscriptionType(subscription_type)
@@ -257,38 +266,32 @@ async def process_successful_payment(payment_info, user_id):
 
             db.add_subscription(user_id, subscription_type_enum, duration_days)
             await send_subscription_confirmation(user_id, subscription_type_enum)
-            logger.info(f"Subscription activated for user {user_id}: {subscription_type}")
+            logger.info("Subscription activated for user %s: %s", user_id, subscription_type)
 
         else:
             if not is_donation:
                 db.update_rub_balance(user_id, amount)
                 db.update_total_topup(user_id, amount)
-                logger.info(f"Balance updated for user {user_id}: +{amount} RUB")
+                logger.info("Balance updated for user %s: +%s RUB", user_id, amount)
             else:
                 db.update_total_donated(user_id, amount)
-                logger.info(f"Donation received from user {user_id}: {amount} RUB")
+                logger.info("Donation received from user %s: %s RUB", user_id, amount)
 
             await send_payment_confirmation(user_id, amount, is_donation)
 
     except Exception as e:
-        logger.error(f"Error processing successful payment: {e}")
+        logger.error("Error processing successful payment: %s", e)
 
 
 async def send_payment_confirmation(user_id, amount_rub, is_donation):
     """Отправляет подтверждение об успешной оплате"""
-    user = db.user_collection.find_one({"_id": user_id})
-    if user:
-        chat_id = user["chat_id"]
-
+    chat_id = await asyncio.to_thread(db.get_user_chat_id, user_id)
+    if chat_id is not None:
         if is_donation:
             message = f"Спасибо за ваше пожертвование *{amount_rub} ₽*! Ваша поддержка очень важна для нас! ❤️❤️"
         else:
             message = f"Пополнение на *{amount_rub} ₽* прошло успешно! 🎉\n\nБаланс обновлен."
-            if user.get("role") == "trial_user":
-                db.user_collection.update_one(
-                    {"_id": user_id},
-                    {"$set": {"role": "regular_user"}}
-                )
+            if await asyncio.to_thread(db.promote_trial_user, user_id):
                 message += "\n\nВаш статус изменен на *обычного пользователя*! Спасибо за поддержку! ❤️"
 
         await bot_instance.send_message(chat_id=chat_id, text=message, parse_mode='Markdown')
@@ -296,10 +299,8 @@ async def send_payment_confirmation(user_id, amount_rub, is_donation):
 
 async def send_subscription_confirmation(user_id, subscription_type):
     """Отправляет подтверждение об активации подписки"""
-    user = db.user_collection.find_one({"_id": user_id})
-    if user:
-        chat_id = user["chat_id"]
-
+    chat_id = await asyncio.to_thread(db.get_user_chat_id, user_id)
+    if chat_id is not None:
         duration_days = SUBSCRIPTION_DURATIONS[subscription_type].days
 
         message = f"🎉 Подписка *{subscription_type.name.replace('_', ' ').title()}* активирована!\n"
@@ -317,7 +318,7 @@ async def create_yookassa_payment(user_id: int, amount_rub: int, context: Callba
             description = "Добровольное пожертвование"
 
         currency = "RUB"
-        payment = Payment.create({
+        payment = await asyncio.to_thread(Payment.create, {
             "amount": {
                 "value": amount_rub,
                 "currency": currency
@@ -363,7 +364,7 @@ async def create_yookassa_payment(user_id: int, amount_rub: int, context: Callba
         return payment.confirmation.confirmation_url, payment.id
 
     except Exception as e:
-        logger.error(f"Error creating Yookassa payment: {e}")
+        logger.error("Error creating Yookassa payment: %s", e)
         raise e
 
 
@@ -375,7 +376,7 @@ async def create_subscription_yookassa_payment(user_id: int, subscription_type:
     try:
         currency = "RUB"
         label = f"Подписка {subscription_type.name.replace('_', ' ').title()}"
-        payment = Payment.create({
+        payment = await asyncio.to_thread(Payment.create, {
             "amount": {
                 "value": price,
                 "currency": currency
@@ -421,7 +422,7 @@ async def create_subscription_yookassa_payment(user_id: int, subscription_type:
         return payment.confirmation.confirmation_url
 
     except Exception as e:
-        logger.error(f"Error creating Yookassa subscription payment: {e}")
+        logger.error("Error creating Yookassa subscription payment: %s", e)
         raise e
 
 
@@ -467,7 +468,7 @@ async def retry_handle(update: Update, context: CallbackContext):
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.update_last_interaction(user_id)
 
     if not await rub_balance_preprocessor(update, context):
         return
@@ -480,7 +481,8 @@ async def retry_handle(update: Update, context: CallbackContext):
     last_dialog_message = dialog_messages.pop()
     db.set_dialog_messages(user_id, dialog_messages, dialog_id=None)
 
-    await message_handle(update, context, message=last_dialog_message["user"], use_new_dialog_timeout=False)
+    await message_handle(update, context, message=last_dialog_message["user"], use_new_dialog_timeout=False,
+                         use_response_cache=False)
 
 
 class CustomEncoder(JSONEncoder):
@@ -529,7 +531,7 @@ async def _vision_message_handle_fn(
         transcribed_text = await openai_utils.transcribe_audio(buf)
         transcribed_text = transcribed_text.strip()
 
-    buf = None
+    encoded_image = None
 
     if update.message.photo:
         photo = update.message.photo[-1]
@@ -537,8 +539,8 @@ async def _vision_message_handle_fn(
 
         buf = io.BytesIO()
         await photo_file.download_to_memory(buf)
-        buf.name = "image.jpg"
-        buf.seek(0)
+        # encoded once: the same string goes to the API and into the dialog history
+        encoded_image = openai_utils.encode_image(buf)
 
     n_input_tokens, n_output_tokens = 0, 0
 
@@ -558,7 +560,7 @@ async def _vision_message_handle_fn(
             gen = chatgpt_instance.send_vision_message_stream(
                 message,
                 dialog_messages=dialog_messages,
-                image_buffer=buf,
+                encoded_image=encoded_image,
                 chat_mode=chat_mode,
             )
         else:
@@ -569,7 +571,7 @@ async def _vision_message_handle_fn(
             ) = await chatgpt_instance.send_vision_message(
                 message,
                 dialog_messages=dialog_messages,
-                image_buffer=buf,
+                encoded_image=encoded_image,
                 chat_mode=chat_mode,
             )
 
@@ -615,8 +617,8 @@ async def _vision_message_handle_fn(
             await asyncio.sleep(0.01)
             prev_answer = answer
 
-        if buf is not None:
-            base_image = base64.b64encode(buf.getvalue()).decode("utf-8")
+        if encoded_image is not None:
+            base_image = encoded_image
             new_dialog_message = {"user": [
                 {
                     "type": "text",
@@ -803,7 +805,7 @@ async def subscription_handle(update: Update, context: CallbackContext):
 
         await register_user_if_not_exists(update, context, user)
         user_id = user.id
-        db.set_user_attribute(user_id, "last_interaction", datetime.now())
+        db.update_last_interaction(user_id)
 
         subscriptions = [
             {
@@ -885,7 +887,7 @@ async def subscription_handle(update: Update, context: CallbackContext):
                     )
 
     except Exception as e:
-        logger.error(f"Error in subscription_handle: {e}")
+        logger.error("Error in subscription_handle: %s", e)
         # Отправляем сообщение об ошибке
         if update.callback_query:
             await update.callback_query.message.reply_text(
@@ -951,7 +953,7 @@ async def subscription_callback_handle(update: Update, context: CallbackContext)
             await query.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
 
         except Exception as e:
-            logger.error(f"Error in subscription payment: {e}")
+            logger.error("Error in subscription payment: %s", e)
             await query.edit_message_text(
                 "❌ Произошла ошибка при создании платежа. Пожалуйста, попробуйте позже.",
                 parse_mode=ParseMode.HTML
@@ -962,7 +964,7 @@ async def check_my_payments_handle(update: Update, context: CallbackContext):
     """Показывает статус pending платежей пользователя"""
     await register_user_if_not_exists(update, context, update.message.from_user)
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.update_last_interaction(user_id)
 
     pending_payments = db.get_user_pending_payments(user_id)
 
@@ -1000,7 +1002,8 @@ async def check_my_payments_handle(update: Update, context: CallbackContext):
 bot_instance = None
 
 
-async def message_handle(update: Update, context: CallbackContext, message=None, use_new_dialog_timeout=True):
+async def message_handle(update: Update, context: CallbackContext, message=None, use_new_dialog_timeout=True,
+                         use_response_cache=True):
     if not await is_bot_mentioned(update, context):
         return
 
@@ -1135,7 +1138,8 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
                     n_output_tokens), n_first_dialog_messages_removed = await chatgpt_instance.send_message(
                     _message,
                     dialog_messages=dialog_messages,
-                    chat_mode=chat_mode
+                    chat_mode=chat_mode,
+                    use_cache=use_response_cache
                 )
 
                 async def fake_gen():
@@ -1257,7 +1261,7 @@ async def voice_message_handle(update: Update, context: CallbackContext):
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.update_last_interaction(user_id)
 
     if not await subscription_preprocessor(update, context):
         return
@@ -1283,8 +1287,7 @@ async def voice_message_handle(update: Update, context: CallbackContext):
 
     audio_duration_minutes = voice.duration / 60.0
 
-    db.set_user_attribute(user_id, "n_transcribed_seconds",
-                          voice.duration + db.get_user_attribute(user_id, "n_transcribed_seconds"))
+    db.update_n_transcribed_seconds(user_id, voice.duration)
     db.deduct_cost_for_action(user_id=user_id, action_type='whisper',
                               action_params={'audio_duration_minutes': audio_duration_minutes})
 
@@ -1307,7 +1310,7 @@ async def generate_image_handle(update: Update, context: CallbackContext, messag
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.update_last_interaction(user_id)
 
     user_preferences = db.get_user_attribute(user_id, "image_preferences")
 
@@ -1325,7 +1328,7 @@ async def generate_image_handle(update: Update, context: CallbackContext, messag
     placeholder_message = await update.message.reply_text("<i>Рисуем...</i>", parse_mode=ParseMode.HTML)
 
     try:
-        image_urls = await openai_utils.generate_images(prompt=message or update.message.text, model=model,
+        images = await openai_utils.generate_images(prompt=message or update.message.text, model=model,
                                                         n_images=n_images, size=resolution)
     except openai.error.InvalidRequestError as e:
         if str(e).startswith("Your request was rejected as a result of our safety system"):
@@ -1333,13 +1336,13 @@ async def generate_image_handle(update: Update, context: CallbackContext, messag
             await update.message.reply_text(text, parse_mode=ParseMode.HTML)
             return
         else:
-            logging.error(f"OpenAI Invalid Request Error: {str(e)}")
+            logging.error("OpenAI Invalid Request Error: %s", e)
             text = f"⚠️ There was an issue with your request. Please try again.\n\n<b>Reason</b>: {str(e)}"
             await update.message.reply_text(text, parse_mode=ParseMode.HTML)
         return
 
     except Exception as e:
-        logging.error(f"Unexpected Error: {str(e)}")
+        logging.error("Unexpected Error: %s", e)
         text = f"⚠️ An unexpected error occurred. Please try again. \n\n<b>Reason</b>: {str(e)}"
         await update.message.reply_text(text, parse_mode=ParseMode.HTML)
         return
@@ -1351,8 +1354,7 @@ async def generate_image_handle(update: Update, context: CallbackContext, messag
         "n_images": n_images
     }
 
-    db.set_user_attribute(user_id, "n_generated_images",
-                          n_images + db.get_user_attribute(user_id, "n_generated_images"))
+    db.update_n_generated_images(user_id, n_images)
     action_type = user_preferences.get("model", "dalle-3")
     db.deduct_cost_for_action(user_id=user_id, action_type=action_type, action_params=action_params)
 
@@ -1360,12 +1362,12 @@ async def generate_image_handle(update: Update, context: CallbackContext, messag
     await context.bot.edit_message_text(pre_generation_message, chat_id=placeholder_message.chat_id,
                                         message_id=placeholder_message.message_id, parse_mode=ParseMode.HTML)
 
-    for image_url in image_urls:
+    for image in images:
         await update.message.chat.send_action(action="upload_photo")
         await upload_image_from_memory(
             bot=context.bot,
             chat_id=update.message.chat_id,
-            image_url=image_url
+            image=image
         )
 
     post_generation_message = f"Нарисовали 🎨:\n\n  <i>{message or ''}</i>  \n\n Как вам??"
@@ -1373,12 +1375,8 @@ async def generate_image_handle(update: Update, context: CallbackContext, messag
                                         message_id=placeholder_message.message_id, parse_mode=ParseMode.HTML)
 
 
-async def upload_image_from_memory(bot, chat_id, image_url):
-    response = requests.get(image_url, stream=True)
-    if response.status_code == 200:
-        image_buffer = io.BytesIO(response.content)
-        image_buffer.name = "image.jpg"
-        await bot.send_photo(chat_id=chat_id, photo=InputFile(image_buffer, "image.jpg"))
+async def upload_image_from_memory(bot, chat_id, image):
+    await bot.send_photo(chat_id=chat_id, photo=image, filename="image.png")
 
 
 async def new_dialog_handle(update: Update, context: CallbackContext):
@@ -1386,7 +1384,7 @@ async def new_dialog_handle(update: Update, context: CallbackContext):
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.update_last_interaction(user_id)
 
     current_model = db.get_user_attribute(user_id, "current_model")
     if current_model == "gpt-4-vision-preview":
@@ -1410,7 +1408,7 @@ async def cancel_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.update_last_interaction(user_id)
 
     if user_id in user_tasks:
         task = user_tasks[user_id]
@@ -1459,21 +1457,21 @@ async def show_chat_modes_handle(update: Update, context: CallbackContext):
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.update_last_interaction(user_id)
 
     text, reply_markup = get_chat_mode_menu(0)
     await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
 
 async def show_chat_modes_callback_handle(update: Update, context: CallbackContext):
+    query = update.callback_query
+    await query.answer()
+
     await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
     if await is_previous_message_not_answered_yet(update.callback_query, context): return
 
     user_id = update.callback_query.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
-
-    query = update.callback_query
-    await query.answer()
+    db.update_last_interaction(user_id)
 
     page_index = int(query.data.split("|")[1])
     if page_index < 0:
@@ -1488,12 +1486,12 @@ async def show_chat_modes_callback_handle(update: Update, context: CallbackConte
 
 
 async def set_chat_mode_handle(update: Update, context: CallbackContext):
-    await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
-    user_id = update.callback_query.from_user.id
-
     query = update.callback_query
     await query.answer()
 
+    await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
+    user_id = update.callback_query.from_user.id
+
     chat_mode = query.data.split("|")[1]
 
     db.set_user_attribute(user_id, "current_chat_mode", chat_mode)
@@ -1506,16 +1504,27 @@ async def set_chat_mode_handle(update: Update, context: CallbackContext):
     )
 
 
-def get_settings_menu(user_id: int):
-    text = "⚙️ Настройки:"
+# подписи кнопок количества изображений dalle-2: (выбрано, количество) -> текст
+N_IMAGES_BUTTON_LABELS = {
+    (is_selected, n): ("✅ " if is_selected else "") + (f"{n} image" if n == 1 else f"{n} images")
+    for n in range(1, 4)
+    for is_selected in (False, True)
+}
 
-    keyboard = [
-        [InlineKeyboardButton("🧠 Модель нейросети", callback_data='model-ai_model')],
-        [InlineKeyboardButton("🎨 Модель художника", callback_data='model-artist_model')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+# неизменяемые клавиатуры меню настроек создаются один раз
+SETTINGS_MENU_REPLY_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🧠 Модель нейросети", callback_data='model-ai_model')],
+    [InlineKeyboardButton("🎨 Модель художника", callback_data='model-artist_model')]
+])
+BACK_TO_SETTINGS_ROW = (InlineKeyboardButton("⬅️", callback_data='model-back_to_settings'),)
 
-    return text, reply_markup
+# значения из callback_data приходят строками; настройки изображений, которые хранятся другим типом
+IMAGE_PREFERENCE_TYPES = {"n_images": int}
+
+
+def get_settings_menu(user_id: int):
+    text = "⚙️ Настройки:"
+    return text, SETTINGS_MENU_REPLY_MARKUP
 
 
 async def settings_handle(update: Update, context: CallbackContext):
@@ -1524,188 +1533,127 @@ async def settings_handle(update: Update, context: CallbackContext):
         return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.update_last_interaction(user_id)
 
     text, reply_markup = get_settings_menu(user_id)
     await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
 
 async def set_settings_handle(update: Update, context: CallbackContext):
-    await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
-    user_id = update.callback_query.from_user.id
-
     query = update.callback_query
     await query.answer()
 
+    await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
+    user_id = update.callback_query.from_user.id
+
     _, model_key = query.data.split("|")
     db.set_user_attribute(user_id, "current_model", model_key)
 
     await display_model_info(query, user_id, context)
 
 
-async def display_model_info(query, user_id, context):
-    current_model = db.get_user_attribute(user_id, "current_model")
-    model_info = config.models["info"][current_model]
-    description = model_info["description"]
-    scores = model_info["scores"]
+def format_model_scores(scores: dict) -> str:
+    return "".join(f"{_SCORE_BARS[score_value]} – {score_key}\n" for score_key, score_value in scores.items())
 
-    details_text = f"{description}\n\n"
-    for score_key, score_value in scores.items():
-        details_text += f"{'🟢' * score_value}{'⚪️' * (5 - score_value)} – {score_key}\n"
 
-    details_text += "\nВыберите <b>модель</b>:"
+# описание и оценки моделей не меняются после загрузки конфига
+MODEL_DETAILS_TEXT = {
+    model_key: f"{model_info['description']}\n\n{format_model_scores(model_info['scores'])}"
+    for model_key, model_info in config.models["info"].items()
+    if "scores" in model_info
+}
 
-    buttons = []
-    claude_buttons = []
-    other_buttons = []
 
-    for model_key in config.models["available_text_models"]:
-        title = config.models["info"][model_key]["name"]
+def get_model_menu_reply_markup(current_model: str):
+    models_info = config.models["info"]
+
+    def model_button(model_key, callback_prefix):
+        title = models_info[model_key]["name"]
         if model_key == current_model:
             title = "✅ " + title
+        return InlineKeyboardButton(title, callback_data=f"{callback_prefix}|{model_key}")
 
-        if "claude" in model_key.lower():
-            callback_data = f"claude-model-set_settings|{model_key}"
-            claude_buttons.append(InlineKeyboardButton(title, callback_data=callback_data))
-        else:
-            callback_data = f"model-set_settings|{model_key}"
-            other_buttons.append(InlineKeyboardButton(title, callback_data=callback_data))
+    other_buttons = [model_button(model_key, "model-set_settings") for model_key in _OTHER_TEXT_MODELS]
+    claude_buttons = [model_button(model_key, "claude-model-set_settings") for model_key in _CLAUDE_TEXT_MODELS]
 
     half_size = len(other_buttons) // 2
     first_row = other_buttons[:half_size]
     second_row = other_buttons[half_size:]
-    back_button = [InlineKeyboardButton("⬅️", callback_data='model-back_to_settings')]
+    return InlineKeyboardMarkup([first_row, second_row, claude_buttons, BACK_TO_SETTINGS_ROW])
+
+
+async def display_model_info(query, user_id, context):
+    current_model = db.get_user_attribute(user_id, "current_model")
+    details_text = MODEL_DETAILS_TEXT[current_model] + "\nВыберите <b>модель</b>:"
 
-    reply_markup = InlineKeyboardMarkup([first_row, second_row, claude_buttons, back_button])
+    reply_markup = get_model_menu_reply_markup(current_model)
+
+    # текст меню определяется отмеченными в клавиатуре вариантами: та же клавиатура — то же сообщение
+    if query.message is not None and query.message.reply_markup == reply_markup:
+        return
 
     try:
         await query.edit_message_text(text=details_text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
     except telegram.error.BadRequest as e:
-        if "Message is not modified" in str(e):
-            pass
+        if not e.message.startswith("Message is not modified"):
+            logger.error("Failed to update settings menu: %s", e)
 
 
 async def model_settings_handler(update: Update, context: CallbackContext):
     query = update.callback_query
     await query.answer()
 
-    data = query.data
     user_id = query.from_user.id
 
-    if data == 'model-ai_model':
-        current_model = db.get_user_attribute(user_id, "current_model")
-        text = f"{config.models['info'][current_model]['description']}\n\n"
+    # callback_data имеет вид "<действие>" или "<действие>|<значение>"
+    action, _, value = query.data.partition("|")
+    handler = MODEL_SETTINGS_HANDLERS.get(action)
+    if handler is not None:
+        await handler(query, context, user_id, value)
 
-        score_dict = config.models["info"][current_model]["scores"]
-        for score_key, score_value in score_dict.items():
-            text += f"{'🟢' * score_value}{'⚪️' * (5 - score_value)} – {score_key}\n"
 
-        text += "\nSelect <b>model</b>:\n"
+async def set_text_model_handler(query, context, user_id, model_key):
+    if "claude" in model_key.lower() and not config.anthropic_api_key:
+        await context.bot.send_message(
+            chat_id=user_id,
+            text="This bot does not have the Anthropic models available :(",
+            parse_mode='Markdown'
+        )
+        return
+    db.set_user_attribute(user_id, "current_model", model_key)
+    await display_model_info(query, user_id, context)
 
-        buttons = []
-        claude_buttons = []
-        other_buttons = []
 
-        for model_key in config.models["available_text_models"]:
-            title = config.models["info"][model_key]["name"]
-            if model_key == current_model:
-                title = "✅ " + title
+async def show_text_model_handler(query, context, user_id, _value):
+    await display_model_info(query, user_id, context)
 
-            if "claude" in model_key.lower():
-                callback_data = f"claude-model-set_settings|{model_key}"
-                claude_buttons.append(InlineKeyboardButton(title, callback_data=callback_data))
-            else:
-                callback_data = f"model-set_settings|{model_key}"
-                other_buttons.append(InlineKeyboardButton(title, callback_data=callback_data))
 
-        half_size = len(other_buttons) // 2
-        first_row = other_buttons[:half_size]
-        second_row = other_buttons[half_size:]
-        back_button = [InlineKeyboardButton("⬅️", callback_data='model-back_to_settings')]
+async def show_artist_model_handler(query, context, user_id, _value):
+    await artist_model_settings_handler(query, user_id)
 
-        reply_markup = InlineKeyboardMarkup([first_row, second_row, claude_buttons, back_button])
 
-        await query.edit_message_text(text=text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+async def set_image_preference_handler(key, query, context, user_id, value):
+    db.set_image_preferences(user_id, **{key: IMAGE_PREFERENCE_TYPES.get(key, str)(value)})
+    await artist_model_settings_handler(query, user_id)
 
-    elif data.startswith('claude-model-set_settings|'):
-        if config.anthropic_api_key is None or config.anthropic_api_key == "":
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="This bot does not have the Anthropic models available :(",
-                parse_mode='Markdown'
-            )
-            return
-        _, model_key = data.split("|")
-        db.set_user_attribute(user_id, "current_model", model_key)
-        await display_model_info(query, user_id, context)
 
-    elif data.startswith('model-set_settings|'):
-        _, model_key = data.split("|")
-        if "claude" in model_key.lower() and (config.anthropic_api_key is None or config.anthropic_api_key == ""):
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="This bot does not have the Anthropic models available :(",
-                parse_mode='Markdown'
-            )
-            return
-        db.set_user_attribute(user_id, "current_model", model_key)
-        await display_model_info(query, user_id, context)
-
-    elif data.startswith('model-artist-set_model|'):
-        _, model_key = data.split("|")
-        await switch_between_artist_handler(query, user_id, model_key)
-
-    elif data == 'model-artist_model':
-        await artist_model_settings_handler(query, user_id)
-
-    elif data.startswith('model-artist-set_model|'):
-        _, model_key = data.split("|")
-        preferences = db.get_user_attribute(user_id, "image_preferences")
-        preferences["model"] = model_key
-        db.set_user_attribute(user_id, "image_preferences", preferences)
-        await artist_model_settings_handler(query, user_id)
-
-    elif data.startswith("model-artist-set_images|"):
-        _, n_images = data.split("|")
-        preferences = db.get_user_attribute(user_id, "image_preferences")
-        preferences["n_images"] = int(n_images)
-        db.set_user_attribute(user_id, "image_preferences", preferences)
-        await artist_model_settings_handler(query, user_id)
-
-    elif data.startswith("model-artist-set_resolution|"):
-        _, resolution = data.split("|")
-        preferences = db.get_user_attribute(user_id, "image_preferences")
-        preferences["resolution"] = resolution
-        db.set_user_attribute(user_id, "image_preferences", preferences)
-        await artist_model_settings_handler(query, user_id)
-
-    elif data.startswith("model-artist-set_quality|"):
-        _, quality = data.split("|")
-        preferences = db.get_user_attribute(user_id, "image_preferences")
-        preferences["quality"] = quality
-        db.set_user_attribute(user_id, "image_preferences", preferences)
-        await artist_model_settings_handler(query, user_id)
-
-    elif data == 'model-back_to_settings':
-        text, reply_markup = get_settings_menu(user_id)
-        await query.edit_message_text(text=text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+async def back_to_settings_handler(query, context, user_id, _value):
+    text, reply_markup = get_settings_menu(user_id)
+    await query.edit_message_text(text=text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
 
 
 async def artist_model_settings_handler(query, user_id):
     current_preferences = db.get_user_attribute(user_id, "image_preferences")
     current_model = current_preferences.get("model", "dalle-2")
 
-    model_info = config.models["info"][current_model]
-    description = model_info["description"]
-    scores = model_info["scores"]
+    models_info = config.models["info"]
+    model_info = models_info[current_model]
 
-    details_text = f"{description}\n\n"
-    for score_key, score_value in scores.items():
-        details_text += f"{'🟢' * score_value}{'⚪️' * (5 - score_value)} – {score_key}\n"
+    details_text = MODEL_DETAILS_TEXT[current_model]
 
     buttons = []
     for model_key in config.models["available_image_models"]:
-        title = config.models["info"][model_key]["name"]
+        title = models_info[model_key]["name"]
         if model_key == current_model:
             title = "✅ " + title
         buttons.append(InlineKeyboardButton(title, callback_data=f"model-artist-set_model|{model_key}"))
@@ -1714,16 +1662,14 @@ async def artist_model_settings_handler(query, user_id):
         details_text += "\nFor this model, choose the number of images to generate and the resolution:"
         n_images = current_preferences.get("n_images", 1)
         images_buttons = [
-            InlineKeyboardButton(
-                f"✅ {i} image" if i == n_images and i == 1 else f"✅ {i} images" if i == n_images else f"{i} image" if i == 1 else f"{i} images",
-                callback_data=f"model-artist-set_images|{i}")
+            InlineKeyboardButton(N_IMAGES_BUTTON_LABELS[(i == n_images, i)], callback_data=f"model-artist-set_images|{i}")
             for i in range(1, 4)
         ]
         current_resolution = current_preferences.get("resolution", "1024x1024")
         resolution_buttons = [
             InlineKeyboardButton(f"✅ {res_key}" if res_key == current_resolution else f"{res_key}",
                                  callback_data=f"model-artist-set_resolution|{res_key}")
-            for res_key in config.models["info"]["dalle-2"]["resolutions"].keys()
+            for res_key in model_info["resolutions"]
         ]
         keyboard = [buttons] + [images_buttons] + [resolution_buttons]
 
@@ -1733,45 +1679,62 @@ async def artist_model_settings_handler(query, user_id):
         quality_buttons = [
             InlineKeyboardButton(f"✅ {quality_key}" if quality_key == current_quality else f"{quality_key}",
                                  callback_data=f"model-artist-set_quality|{quality_key}")
-            for quality_key in config.models["info"]["dalle-3"]["qualities"].keys()
+            for quality_key in model_info["qualities"]
         ]
         current_resolution = current_preferences.get("resolution", "1024x1024")
         resolution_buttons = [
             InlineKeyboardButton(f"✅ {res_key}" if res_key == current_resolution else f"{res_key}",
                                  callback_data=f"model-artist-set_resolution|{res_key}")
-            for res_key in config.models["info"]["dalle-3"]["qualities"][current_quality]["resolutions"].keys()
+            for res_key in model_info["qualities"][current_quality]["resolutions"]
         ]
         keyboard = [buttons] + [quality_buttons] + [resolution_buttons]
     else:
         keyboard = [buttons]
 
-    keyboard.append([InlineKeyboardButton("⬅️", callback_data='model-back_to_settings')])
+    keyboard.append(BACK_TO_SETTINGS_ROW)
     reply_markup = InlineKeyboardMarkup(keyboard)
 
+    # текст меню определяется отмеченными в клавиатуре вариантами: та же клавиатура — то же сообщение
+    if query.message is not None and query.message.reply_markup == reply_markup:
+        return
+
     try:
         await query.edit_message_text(text=details_text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
     except telegram.error.BadRequest as e:
-        if "Message is not modified" in str(e):
-            pass
+        if not e.message.startswith("Message is not modified"):
+            logger.error("Failed to update settings menu: %s", e)
 
 
-async def switch_between_artist_handler(query, user_id, model_key):
-    preferences = db.get_user_attribute(user_id, "image_preferences")
-    preferences["model"] = model_key
+async def switch_between_artist_handler(query, context, user_id, model_key):
+    preferences = {"model": model_key, "resolution": "1024x1024"}
     if model_key == "dalle-2":
         preferences["quality"] = "standard"
     elif model_key == "dalle-3":
         preferences["n_images"] = 1
-    preferences["resolution"] = "1024x1024"
-    db.set_user_attribute(user_id, "image_preferences", preferences)
+    db.set_image_preferences(user_id, **preferences)
     await artist_model_settings_handler(query, user_id)
 
 
+# обработчики model_settings_handler по действию из callback_data;
+# все вызываются как handler(query, context, user_id, value)
+MODEL_SETTINGS_HANDLERS = {
+    'model-ai_model': show_text_model_handler,
+    'model-set_settings': set_text_model_handler,
+    'claude-model-set_settings': set_text_model_handler,
+    'model-artist_model': show_artist_model_handler,
+    'model-artist-set_model': switch_between_artist_handler,
+    'model-artist-set_images': functools.partial(set_image_preference_handler, "n_images"),
+    'model-artist-set_resolution': functools.partial(set_image_preference_handler, "resolution"),
+    'model-artist-set_quality': functools.partial(set_image_preference_handler, "quality"),
+    'model-back_to_settings': back_to_settings_handler,
+}
+
+
 async def show_balance_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.update_last_interaction(user_id)
 
     current_rub_balance = db.get_user_rub_balance(user_id)
 
@@ -1860,8 +1823,7 @@ async def error_handle(update: Update, context: CallbackContext) -> None:
     if update and update.effective_user:
         user_id = update.effective_user.id
 
-    admin_ids = config.roles.get('admin', [])
-    is_admin = user_id in admin_ids
+    is_admin = user_id in config.admin_ids
     developer = config.developer_username
 
     try:
@@ -1903,7 +1865,7 @@ async def handle_main_menu_buttons(update: Update, context: CallbackContext):
     """
     await register_user_if_not_exists(update, context, update.message.from_user)
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.update_last_interaction(user_id)
 
     text = update.message.text
 
@@ -1938,7 +1900,7 @@ async def handle_main_menu_buttons(update: Update, context: CallbackContext):
         await help_handle(update, context)
 
     elif text == emoji.emojize("Админ-панель :smiling_face_with_sunglasses:"):
-        if user_id in config.roles.get('admin', []):
+        if user_id in config.admin_ids:
             await show_admin_panel(update, context)
         else:
             await update.message.reply_text("У вас нет доступа к админ-панели.")
@@ -1969,7 +1931,7 @@ async def handle_back_button(update: Update, context: CallbackContext):
     """
     await register_user_if_not_exists(update, context, update.message.from_user)
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    db.update_last_interaction(user_id)
 
     reply_markup = await BotKeyboards.get_main_keyboard(user_id)
     await update.message.reply_text(
@@ -1998,6 +1960,7 @@ def run_bot() -> None:
         .http_version("1.1")
         .get_updates_http_version("1.1")
         .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .build()
     )
 
@@ -2155,13 +2118,18 @@ async def post_init(application: Application):
         )
 
 
+async def post_shutdown(application: Application):
+    # закрываем общий пул соединений к OpenAI
+    await openai_utils.close_openai_session()
+
+
 # Обертка для проверки платежей, совместимая с job_queue
 async def check_pending_payments_wrapper(context: CallbackContext):
     """Обертка для проверки платежей, совместимая с job_queue"""
     try:
         await check_pending_payments()
     except Exception as e:
-        logger.error(f"Error in payment checking job: {e}")
+        logger.error("Error in payment checking job: %s", e)
 
 
 async def check_pending_payments():
@@ -2173,11 +2141,10 @@ async def check_pending_payments():
             user_id = payment["user_id"]
 
             try:
-                payment_info = Payment.find_one(payment_id)
+                payment_info = await asyncio.to_thread(Payment.find_one, payment_id)
 
-                for admin_id in config.roles['admin']:
-                    if user_id == admin_id:
-                        await process_successful_payment(payment_info, user_id)
+                if user_id in config.admin_ids:
+                    await process_successful_payment(payment_info, user_id)
 
                 status = payment_info.status
 
@@ -2186,13 +2153,13 @@ async def check_pending_payments():
                 if status == 'succeeded':
                     await process_successful_payment(payment_info, user_id)
                 elif status == 'canceled':
-                    logger.info(f"Payment {payment_id} was canceled")
+                    logger.info("Payment %s was canceled", payment_id)
 
             except Exception as e:
-                logger.error(f"Error checking payment {payment_id}: {e}")
+                logger.error("Error checking payment %s: %s", payment_id, e)
 
     except Exception as e:
-        logger.error(f"Error in payment checking: {e}")
+        logger.error("Error in payment checking: %s", e)
 
 if __name__ == "__main__":
     run_bot()
\ No newline at end of file
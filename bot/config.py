@@ -31,6 +31,7 @@ mongodb_uri = f"mongodb://mongo:{config_env['MONGODB_PORT']}"
 model_pricing = config_yaml.get('model_pricing', {})
 role_deduction_rates = config_yaml.get('role_deduction_rates', {})
 roles = config_yaml.get('roles', {})
+admin_ids = frozenset(roles.get('admin', []))
 
 # chat_modes
 with open(config_dir / "chat_modes.yml", 'r') as f:
@@ -1,10 +1,25 @@
 from typing import Optional, Any
+import copy
 import pymongo
 import uuid
 from datetime import datetime, timedelta
 import config
+from ttl_cache import TTLCache
 from subscription import SubscriptionType, SUBSCRIPTION_PRICES, SUBSCRIPTION_DURATIONS
 
+# user settings read on every menu tap; they are only written through this class, so they are cached write-through
+CACHED_USER_ATTRIBUTES = frozenset({"current_model", "image_preferences"})
+USER_SETTINGS_CACHE_TTL = 300  # seconds
+USER_SETTINGS_CACHE_MAX_SIZE = 10000
+
+# chat_id never changes for a user; the ttl only keeps users who went quiet from staying in memory
+CHAT_ID_CACHE_MAX_SIZE = 10000
+CHAT_ID_CACHE_TTL = 3600  # seconds
+
+# last_interaction is refreshed by nearly every handler; writes closer together than this are skipped
+LAST_INTERACTION_WRITE_INTERVAL = 30  # seconds
+LAST_INTERACTION_CACHE_MAX_SIZE = 10000
+
 
 class Database:
     def __init__(self):
@@ -16,6 +31,11 @@ class Database:
         self.dialog_collection = self.db["dialog"]
         self.payment_collection = self.db["payments"]
 
+        self._chat_id_cache = TTLCache(CHAT_ID_CACHE_MAX_SIZE, ttl=CHAT_ID_CACHE_TTL)
+        self._settings_cache = TTLCache(USER_SETTINGS_CACHE_MAX_SIZE, ttl=USER_SETTINGS_CACHE_TTL)  # (user_id, key) -> value
+        # users whose last_interaction was written within the interval
+        self._last_interaction_writes = TTLCache(LAST_INTERACTION_CACHE_MAX_SIZE, ttl=LAST_INTERACTION_WRITE_INTERVAL)
+
     def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
         if self.user_collection.count_documents({"_id": user_id}) > 0:
             return True
@@ -100,18 +120,63 @@ class Database:
         return dialog_id
 
     def get_user_attribute(self, user_id: int, key: str):
+        if key in CACHED_USER_ATTRIBUTES:
+            cached = self._settings_cache.get((user_id, key))
+            if cached is not None:
+                return copy.deepcopy(cached)
+
         self.check_if_user_exists(user_id, raise_exception=True)
         user_dict = self.user_collection.find_one({"_id": user_id})
 
         if key not in user_dict:
             return None
 
+        if key in CACHED_USER_ATTRIBUTES:
+            self._cache_user_setting(user_id, key, user_dict[key])
+
         return user_dict[key]
 
+    def _cache_user_setting(self, user_id: int, key: str, value: Any):
+        self._settings_cache.set((user_id, key), copy.deepcopy(value))
+
+    def get_user_chat_id(self, user_id: int) -> Optional[int]:
+        chat_id = self._chat_id_cache.get(user_id)
+        if chat_id is None:
+            user_dict = self.user_collection.find_one({"_id": user_id}, {"chat_id": 1})
+            if user_dict is None:
+                return None
+
+            chat_id = user_dict["chat_id"]
+            self._chat_id_cache.set(user_id, chat_id)
+
+        return chat_id
+
     def set_user_attribute(self, user_id: int, key: str, value: Any):
         self.check_if_user_exists(user_id, raise_exception=True)
         self.user_collection.update_one({"_id": user_id}, {"$set": {key: value}})
 
+        if key in CACHED_USER_ATTRIBUTES:
+            self._cache_user_setting(user_id, key, value)
+
+    def set_image_preferences(self, user_id: int, **preferences):
+        # only the given fields are written, so concurrent changes to other preferences are not lost
+        user_dict = self.user_collection.find_one_and_update(
+            {"_id": user_id},
+            {"$set": {f"image_preferences.{key}": value for key, value in preferences.items()}},
+            projection={"image_preferences": 1},
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+        # the menu is re-rendered right after a change, so keep the updated preferences at hand
+        if user_dict is not None:
+            self._cache_user_setting(user_id, "image_preferences", user_dict["image_preferences"])
+
+    def update_last_interaction(self, user_id: int):
+        if self._last_interaction_writes.get(user_id) is not None:
+            return
+
+        self._last_interaction_writes.set(user_id, True)
+        self.user_collection.update_one({"_id": user_id}, {"$set": {"last_interaction": datetime.now()}})
+
     def update_n_used_tokens(self, user_id: int, model: str, n_input_tokens: int, n_output_tokens: int):
         n_used_tokens_dict = self.get_user_attribute(user_id, "n_used_tokens")
 
@@ -168,6 +233,14 @@ class Database:
             return user["role"]
         return "trial_User"  # Default role if not explicitly set
 
+    def promote_trial_user(self, user_id: int) -> bool:
+        """Make a trial user a regular user; returns whether the role was changed."""
+        result = self.user_collection.update_one(
+            {"_id": user_id, "role": "trial_user"},
+            {"$set": {"role": "regular_user"}}
+        )
+        return result.modified_count > 0
+
     def get_user_model(self, user_id: int) -> str:
         """Determine the model of a user based on their user ID."""
         user = self.user_collection.find_one({"_id": user_id})
@@ -234,6 +307,18 @@ class Database:
             {"$inc": {"total_donated": amount}}
         )
 
+    def update_n_generated_images(self, user_id: int, n_images: int):
+        self.user_collection.update_one(
+            {"_id": user_id},
+            {"$inc": {"n_generated_images": n_images}}
+        )
+
+    def update_n_transcribed_seconds(self, user_id: int, seconds: float):
+        self.user_collection.update_one(
+            {"_id": user_id},
+            {"$inc": {"n_transcribed_seconds": seconds}}
+        )
+
     def get_user_euro_balance(self, user_id: int) -> float:
 
         user = self.user_collection.find_one({"_id": user_id})
@@ -71,7 +71,7 @@ class BotKeyboards:
         ])
 
         # Кнопка админ-панели для администраторов
-        if user_id in config.roles.get('admin', []):
+        if user_id in config.admin_ids:
             keyboard.append([KeyboardButton(emoji.emojize("Админ-панель :smiling_face_with_sunglasses:"))])
 
         return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
@@ -1,12 +1,20 @@
-import base64
+import asyncio
+import functools
+import hashlib
+import time
 from io import BytesIO
 import config
 import logging
+from ttl_cache import TTLCache
 
-import tiktoken
+import aiohttp
+import orjson
 import openai
-import anthropic
-import logging
+
+try:
+    import pybase64 as base64  # simd encoder, same api as the stdlib module
+except ImportError:
+    import base64
 
 import json #logging error
 
@@ -14,22 +22,71 @@ import json #logging error
 
 # setup openai
 openai.api_key = config.openai_api_key
-anthropic.api_key = config.anthropic_api_key
 
 if config.openai_api_base is not None:
     openai.api_base = config.openai_api_base
 
+_OPENAI_CHAT_MODELS = frozenset({
+    "gpt-3.5-turbo-16k", "gpt-3.5-turbo", "gpt-4", "gpt-4-1106-preview", "gpt-4-vision-preview",
+    "gpt-4-turbo-2024-04-09", "gpt-4o",
+})
+_CLAUDE_MODELS = frozenset({"claude-3-opus-20240229", "claude-3-sonnet-20240229", "claude-3-haiku-20240307"})
+_SUPPORTED_MODELS = _OPENAI_CHAT_MODELS | _CLAUDE_MODELS | {"text-davinci-003"}
+
+# connection pool shared by all openai requests
+OPENAI_MAX_CONNECTIONS = 200
+OPENAI_KEEPALIVE_TIMEOUT = 30  # seconds
+OPENAI_CONNECT_TIMEOUT = 10  # seconds
+OPENAI_TOTAL_TIMEOUT = 60.0  # seconds
+# (connect, total); openai 0.28 builds a ClientTimeout from this for every request, overriding the session's
+OPENAI_REQUEST_TIMEOUT = (OPENAI_CONNECT_TIMEOUT, OPENAI_TOTAL_TIMEOUT)
+
+# exact-match cache for non-streamed answers
+RESPONSE_CACHE_MAX_SIZE = 1024
+RESPONSE_CACHE_TTL = 300  # seconds
+
+# token counts of individual dialog texts, so history is not re-tokenized every turn
+TEXT_TOKEN_CACHE_MAX_SIZE = 4096
+# encode_ordinary_batch starts a thread pool per call, which only pays off for many texts at once
+TOKEN_BATCH_MIN_TEXTS = 64
+
+# moderation verdicts are cached per prompt; prompts shorter than this are not sent at all
+MODERATION_CACHE_MAX_SIZE = 2048
+MODERATION_MIN_PROMPT_LENGTH = 4
+
+# image requests in flight at once across all users, to stay under the images rate limit
+IMAGE_MAX_CONCURRENT_REQUESTS = 10
+
+# a streaming loop hands the partial answer to the caller at most this often
+STREAM_YIELD_MIN_CHARS = 64
+STREAM_YIELD_MIN_INTERVAL = 0.5  # seconds
+
 OPENAI_COMPLETION_OPTIONS = {
     "temperature": 0.7,
     "max_tokens": 1000,
     "top_p": 1,
     "frequency_penalty": 0,
     "presence_penalty": 0,
-    "request_timeout": 60.0,
+    "request_timeout": OPENAI_REQUEST_TIMEOUT,
 }
 
 logger = logging.getLogger(__name__)
 
+# system message per chat mode, built once and shared by every request (never mutated);
+# modes without a prompt (artist, stenographer) never reach the chat api
+_SYSTEM_MSGS = {
+    chat_mode: {"role": "system", "content": chat_mode_dict["prompt_start"]}
+    for chat_mode, chat_mode_dict in config.chat_modes.items()
+    if "prompt_start" in chat_mode_dict
+}
+
+# same prompt as a claude system block; marked cacheable because it is identical for every turn of every dialog in the mode
+_CLAUDE_SYSTEM_BLOCKS = {
+    chat_mode: [{"type": "text", "text": chat_mode_dict["prompt_start"], "cache_control": {"type": "ephemeral"}}]
+    for chat_mode, chat_mode_dict in config.chat_modes.items()
+    if "prompt_start" in chat_mode_dict
+}
+
 def configure_logging():
     # Configure logging based on the enable_detailed_logging value
     if config.enable_detailed_logging:
@@ -42,86 +99,155 @@ def configure_logging():
 
 configure_logging()
 
-def validate_payload(payload): #maybe comment out
-    # Example validation: Ensure all messages have content that is a string
-    for message in payload.get("messages", []):
-        if not isinstance(message.get("content"), str):
-            logger.error("Invalid message content: Not a string")
-            raise ValueError("Message content must be a string")
+_openai_session = None
+
+def _use_shared_openai_session():
+    # openai 0.28 opens a fresh aiohttp session (and TLS connection) per request unless
+    # openai.aiosession is set; it is a ContextVar, so set it in every calling task
+    global _openai_session
+    if _openai_session is None or _openai_session.closed:
+        _openai_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=OPENAI_MAX_CONNECTIONS, keepalive_timeout=OPENAI_KEEPALIVE_TIMEOUT)
+        )
+    openai.aiosession.set(_openai_session)
+
+async def close_openai_session():
+    global _openai_session
+    if _openai_session is not None and not _openai_session.closed:
+        await _openai_session.close()
+    _openai_session = None
+
+_anthropic_client = None
+
+def _get_anthropic_client():
+    # one client for the whole process so its connection pool is reused between requests;
+    # created lazily because anthropic_api_key is optional
+    global _anthropic_client
+    if _anthropic_client is None:
+        import anthropic  # only needed once a claude model is actually used
+        _anthropic_client = anthropic.AsyncAnthropic(api_key=config.anthropic_api_key)
+    return _anthropic_client
+
+# tiktoken encoding per model family, checked in order; claude has no public tokenizer,
+# so it is approximated with the gpt-4o one
+_ENCODING_BY_MODEL_PREFIX = (
+    ("gpt-4o", "o200k_base"),
+    ("claude", "o200k_base"),
+    ("gpt-4", "cl100k_base"),
+    ("gpt-3.5", "cl100k_base"),
+)
+
+@functools.lru_cache(maxsize=16)
+def _get_encoding(model):
+    import tiktoken  # loads its BPE tables on first use, so keep it off the startup path
+    for model_prefix, encoding_name in _ENCODING_BY_MODEL_PREFIX:
+        if model.startswith(model_prefix):
+            return tiktoken.get_encoding(encoding_name)
+    return tiktoken.encoding_for_model(model)
+
+def _is_context_length_error(error):
+    # only this kind of InvalidRequestError is fixed by dropping old dialog messages;
+    # anything else (bad params, content policy, ...) would fail again on every retry
+    return error.code == "context_length_exceeded" or "maximum context length" in str(error)
+
+_text_token_cache = TTLCache(TEXT_TOKEN_CACHE_MAX_SIZE)
+
+_response_cache = TTLCache(RESPONSE_CACHE_MAX_SIZE, ttl=RESPONSE_CACHE_TTL)
+
+def _response_cache_key(model, chat_mode, dialog_messages, message):
+    dialog = [(dialog_message["user"], dialog_message["bot"]) for dialog_message in dialog_messages]
+    payload = orjson.dumps([model, chat_mode, dialog, message], option=orjson.OPT_SORT_KEYS, default=str)
+    return hashlib.sha256(payload).hexdigest()
+
+def encode_image(image_buffer: BytesIO) -> str:
+    # getbuffer() neither copies the image nor moves the read position
+    return base64.b64encode(image_buffer.getbuffer()).decode("ascii")
+
+class _StreamThrottle:
+    """Coalesces streamed deltas so the caller is not woken up for every token"""
+
+    def __init__(self):
+        self.last_len = 0
+        self.last_time = time.monotonic()
+
+    def ready(self, answer_len):
+        now = time.monotonic()
+        if answer_len - self.last_len >= STREAM_YIELD_MIN_CHARS or now - self.last_time >= STREAM_YIELD_MIN_INTERVAL:
+            self.last_len, self.last_time = answer_len, now
+            return True
+        return False
 
         
 class ChatGPT:
     def __init__(self, model="gpt-4-1106-preview"):
-        assert model in {"text-davinci-003", "gpt-3.5-turbo-16k", "gpt-3.5-turbo", "gpt-4", "gpt-4-1106-preview", "gpt-4-vision-preview", "gpt-4-turbo-2024-04-09", "gpt-4o", "claude-3-opus-20240229", "claude-3-sonnet-20240229", "claude-3-haiku-20240307"}, f"Unknown model: {model}"
+        assert model in _SUPPORTED_MODELS, f"Unknown model: {model}"
         self.model = model
         self.is_claude_model = model.startswith("claude")
+        self._chat_completion_kwargs = {"model": model, **OPENAI_COMPLETION_OPTIONS}
         self.logger = logging.getLogger(__name__)
         self.headers = {
             "Authorization": f"Bearer {config.anthropic_api_key if self.is_claude_model else config.openai_api_key}",
             "Content-Type": "application/json",
         }
 
-    async def send_message(self, message, dialog_messages=[], chat_mode="assistant"):
-        if chat_mode not in config.chat_modes.keys():
+    async def send_message(self, message, dialog_messages=[], chat_mode="assistant", use_cache=True):
+        if chat_mode not in config.chat_modes:
             raise ValueError(f"Chat mode {chat_mode} is not supported")
 
+        cache_key = _response_cache_key(self.model, chat_mode, dialog_messages, message) if use_cache else None
+        if cache_key is not None:
+            cached = _response_cache.get(cache_key)
+            if cached is not None:
+                # the dialog is part of the key, so the same number of old messages has to be dropped again
+                return cached
+
+        _use_shared_openai_session()
+
         n_dialog_messages_before = len(dialog_messages)
         answer = None
         while answer is None:
             try:
                 if self.is_claude_model:
                     prompt = self._generate_claude_prompt(message, dialog_messages, chat_mode)
-                    self.logger.debug(f"Claude prompt: {prompt}")
+                    self.logger.debug("Claude prompt: %s", prompt)
 
                     if not prompt.strip():
                         raise ValueError("Generated prompt is empty")
 
-                    client = anthropic.AsyncAnthropic(api_key=config.anthropic_api_key)
-                    response = await client.completions.create(
+                    client = _get_anthropic_client()
+                    response = await client.messages.create(
                         model=self.model,
+                        system=_CLAUDE_SYSTEM_BLOCKS[chat_mode],
                         messages=[{"role": "user", "content": prompt}],
                         max_tokens=1000,
                         temperature=0.7
                     )
-                    self.logger.debug(f"Claude API response: {response}")
+                    self.logger.debug("Claude API response: %s", response)
 
                     answer = ""
                     for text_block in response.content:
-                        self.logger.debug(f"TextBlock: {text_block}")
+                        self.logger.debug("TextBlock: %s", text_block)
                         answer += text_block.text
 
                     if not answer.strip():
                         self.logger.error("Received empty response from Claude API.")
                         raise ValueError("Received empty response from Claude API.")
 
-                    n_input_tokens, n_output_tokens = self._count_tokens_from_messages([], answer, model=self.model)
+                    n_input_tokens, n_output_tokens = self._claude_usage(response.usage)
                 else:
-                    if self.model in {"gpt-3.5-turbo-16k", "gpt-3.5-turbo", "gpt-4", "gpt-4-1106-preview", "gpt-4-vision-preview", "gpt-4-turbo-2024-04-09", "gpt-4o"}:
+                    if self.model in _OPENAI_CHAT_MODELS:
                         messages = self._generate_prompt_messages(message, dialog_messages, chat_mode)
-                        #GPT HELP 2
-                        validate_payload({
-                            "model": self.model,
-                            "messages": messages,
-                            **OPENAI_COMPLETION_OPTIONS
-                        })
-                        #GPT HELP 2
                         r = await openai.ChatCompletion.acreate(
-                            model=self.model,
                             messages=messages,
-                            **OPENAI_COMPLETION_OPTIONS
+                            **self._chat_completion_kwargs
                         )
                         answer = r.choices[0].message["content"]
+                        if self.logger.isEnabledFor(logging.DEBUG):
+                            # some openai_api_base backends send prompt_tokens_details as null
+                            self.logger.debug("OpenAI cached input tokens: %s", (r.usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0))
                     elif self.model == "text-davinci-003":
                         prompt = self._generate_prompt(message, dialog_messages, chat_mode)
 
-                        #GPT HELP 2
-                        validate_payload({
-                            "model": self.model,
-                            "messages": messages,
-                            **OPENAI_COMPLETION_OPTIONS
-                        })
-                        #GPT HELP 2
-
                         r = await openai.Completion.acreate(
                             engine=self.model,
                             prompt=prompt,
@@ -131,9 +257,13 @@ class ChatGPT:
                     else:
                         raise ValueError(f"Unknown model: {self.model}")
 
+                    n_input_tokens, n_output_tokens = r.usage.prompt_tokens, r.usage.completion_tokens
+
                 answer = self._postprocess_answer(answer)
-                n_input_tokens, n_output_tokens = r.usage.prompt_tokens, r.usage.completion_tokens
             except openai.error.InvalidRequestError as e:  # too many tokens
+                if not _is_context_length_error(e):
+                    raise
+
                 if len(dialog_messages) == 0:
                     raise ValueError("Dialog messages is reduced to zero, but still has too many tokens to make completion") from e
 
@@ -142,12 +272,17 @@ class ChatGPT:
 
         n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
 
+        if cache_key is not None:
+            _response_cache.set(cache_key, (answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed))
+
         return answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
 
     async def send_message_stream(self, message, dialog_messages=[], chat_mode="assistant"):
-        if chat_mode not in config.chat_modes.keys():
+        if chat_mode not in config.chat_modes:
             raise ValueError(f"Chat mode {chat_mode} is not supported")
 
+        _use_shared_openai_session()
+
         n_dialog_messages_before = len(dialog_messages)
         answer = None
         n_input_tokens, n_output_tokens, n_first_dialog_messages_removed = 0, 0, 0
@@ -159,51 +294,71 @@ class ChatGPT:
                     if not prompt.strip():
                         raise ValueError("Generated prompt is empty")
                     
-                    client = anthropic.AsyncAnthropic(api_key=config.anthropic_api_key)
+                    client = _get_anthropic_client()
+
+                    encoding = _get_encoding(self.model)
+                    throttle = _StreamThrottle()
+                    n_input_tokens, n_output_tokens = self._count_tokens_from_messages([], "", model=self.model)
 
                     async with client.messages.stream(
                         model=self.model,
+                        system=_CLAUDE_SYSTEM_BLOCKS[chat_mode],
                         messages=[{"role": "user", "content": prompt}],
                         max_tokens=1000,
                         temperature=0.0#0.7
                     ) as stream:
+                        answer_parts, answer_len = [], 0
                         async for event in stream.text_stream:
                             #self.logger.debug(f"Event: {event}")
                             if event:
                                 if isinstance(event, str):
-                                    if answer is None:
-                                        answer = event
-                                    else:
-                                        answer += event
-                                    n_input_tokens, n_output_tokens = self._count_tokens_from_messages([], answer, model=self.model)
-                                    yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
-   
+                                    answer_parts.append(event)
+                                    answer_len += len(event)
+                                    n_output_tokens += len(encoding.encode_ordinary(event))
+                                    if throttle.ready(answer_len):
+                                        yield "not_finished", "".join(answer_parts), (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+
+                        # bill the streamed answer from the api usage, same as send_message
+                        final_message = await stream.get_final_message()
+
+                    answer = "".join(answer_parts)
                     if not answer.strip():
                         raise ValueError("Received empty response from Claude API.")
 
+                    n_input_tokens, n_output_tokens = self._claude_usage(final_message.usage)
+
                 else:
 
-                    if self.model in {"gpt-3.5-turbo-16k", "gpt-3.5-turbo", "gpt-4", "gpt-4-1106-preview", "gpt-4-turbo-2024-04-09", "gpt-4o"}:
+                    if self.model in _OPENAI_CHAT_MODELS:
                         messages = self._generate_prompt_messages(message, dialog_messages, chat_mode)
                         
                         r_gen = await openai.ChatCompletion.acreate(
-                            model=self.model,
                             messages=messages,
                             stream=True,
-                            **OPENAI_COMPLETION_OPTIONS
+                            **self._chat_completion_kwargs
                         )
 
-                        answer = ""
+                        # input is fixed for the whole stream, so count it once and only encode the deltas
+                        encoding = _get_encoding(self.model)
+                        throttle = _StreamThrottle()
+                        n_input_tokens, n_output_tokens = self._count_tokens_from_messages(messages, "", model=self.model)
+
+                        answer_parts, answer_len = [], 0
                         async for r_item in r_gen:
                             delta = r_item.choices[0].delta
 
                             if "content" in delta:
-                                answer += delta.content
-                                n_input_tokens, n_output_tokens = self._count_tokens_from_messages(messages, answer, model=self.model)
+                                answer_parts.append(delta.content)
+                                answer_len += len(delta.content)
+                                n_output_tokens += len(encoding.encode_ordinary(delta.content))
                                 n_first_dialog_messages_removed = 0  #n_dialog_messages_before - len(dialog_messages) #repo commit
 
-                                yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
-                                
+                                if throttle.ready(answer_len):
+                                    yield "not_finished", "".join(answer_parts), (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+
+                        answer = "".join(answer_parts)
+                        n_input_tokens, n_output_tokens = self._count_tokens_from_messages(messages, answer, model=self.model)
+
                     elif self.model == "text-davinci-003":
                         prompt = self._generate_prompt(message, dialog_messages, chat_mode)
                         r_gen = await openai.Completion.acreate(
@@ -213,16 +368,29 @@ class ChatGPT:
                             **OPENAI_COMPLETION_OPTIONS
                         )
 
-                        answer = ""
+                        encoding = _get_encoding(self.model)
+                        throttle = _StreamThrottle()
+                        n_input_tokens, n_output_tokens = self._count_tokens_from_prompt(prompt, "", model=self.model)
+
+                        answer_parts, answer_len = [], 0
                         async for r_item in r_gen:
-                            answer += r_item.choices[0].text
-                            n_input_tokens, n_output_tokens = self._count_tokens_from_prompt(prompt, answer, model=self.model)
+                            text = r_item.choices[0].text
+                            answer_parts.append(text)
+                            answer_len += len(text)
+                            n_output_tokens += len(encoding.encode_ordinary(text))
                             n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
-                            yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+                            if throttle.ready(answer_len):
+                                yield "not_finished", "".join(answer_parts), (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+
+                        answer = "".join(answer_parts)
+                        n_input_tokens, n_output_tokens = self._count_tokens_from_prompt(prompt, answer, model=self.model)
 
                 answer = self._postprocess_answer(answer)
 
             except openai.error.InvalidRequestError as e:  # too many tokens
+                if not _is_context_length_error(e):
+                    raise
+
                 if len(dialog_messages) == 0:
                     raise e
 
@@ -238,19 +406,26 @@ class ChatGPT:
         dialog_messages=[],
         chat_mode="assistant",
         image_buffer: BytesIO = None,
+        encoded_image: str = None,
     ):
+        _use_shared_openai_session()
+
+        # encode once; the retry loop below rebuilds the prompt with the same image.
+        # callers that also store the image pass it already encoded
+        if encoded_image is None and image_buffer is not None:
+            encoded_image = encode_image(image_buffer)
+
         n_dialog_messages_before = len(dialog_messages)
         answer = None
         while answer is None:
             try:
                 if self.model == "gpt-4-vision-preview":
                     messages = self._generate_prompt_messages(
-                        message, dialog_messages, chat_mode, image_buffer
+                        message, dialog_messages, chat_mode, encoded_image
                     )
                     r = await openai.ChatCompletion.acreate(
-                        model=self.model,
                         messages=messages,
-                        **OPENAI_COMPLETION_OPTIONS
+                        **self._chat_completion_kwargs
                     )
                     answer = r.choices[0].message.content
                 else:
@@ -262,6 +437,9 @@ class ChatGPT:
                     r.usage.completion_tokens,
                 )
             except openai.error.InvalidRequestError as e:  # too many tokens
+                if not _is_context_length_error(e):
+                    raise
+
                 if len(dialog_messages) == 0:
                     raise ValueError(
                         "Dialog messages is reduced to zero, but still has too many tokens to make completion"
@@ -286,45 +464,70 @@ class ChatGPT:
         dialog_messages=[],
         chat_mode="assistant",
         image_buffer: BytesIO = None,
+        encoded_image: str = None,
     ):
+        _use_shared_openai_session()
+
+        # encode once; the retry loop below rebuilds the prompt with the same image.
+        # callers that also store the image pass it already encoded
+        if encoded_image is None and image_buffer is not None:
+            encoded_image = encode_image(image_buffer)
+
         n_dialog_messages_before = len(dialog_messages)
         answer = None
         while answer is None:
             try:
                 if self.model == "gpt-4-vision-preview":
                     messages = self._generate_prompt_messages(
-                        message, dialog_messages, chat_mode, image_buffer
+                        message, dialog_messages, chat_mode, encoded_image
                     )
                     
                     r_gen = await openai.ChatCompletion.acreate(
-                        model=self.model,
                         messages=messages,
                         stream=True,
-                        **OPENAI_COMPLETION_OPTIONS,
+                        **self._chat_completion_kwargs
                     )
 
-                    answer = ""
+                    encoding = _get_encoding(self.model)
+                    throttle = _StreamThrottle()
+                    (
+                        n_input_tokens,
+                        n_output_tokens,
+                    ) = self._count_tokens_from_messages(
+                        messages, "", model=self.model
+                    )
+
+                    answer_parts, answer_len = [], 0
                     async for r_item in r_gen:
                         delta = r_item.choices[0].delta
                         if "content" in delta:
-                            answer += delta.content
-                            (
-                                n_input_tokens,
-                                n_output_tokens,
-                            ) = self._count_tokens_from_messages(
-                                messages, answer, model=self.model
-                            )
+                            answer_parts.append(delta.content)
+                            answer_len += len(delta.content)
+                            n_output_tokens += len(encoding.encode_ordinary(delta.content))
                             n_first_dialog_messages_removed = (
                                 n_dialog_messages_before - len(dialog_messages)
                             )
-                            yield "not_finished", answer, (
-                                n_input_tokens,
-                                n_output_tokens,
-                            ), n_first_dialog_messages_removed
+                            if throttle.ready(answer_len):
+                                yield "not_finished", "".join(answer_parts), (
+                                    n_input_tokens,
+                                    n_output_tokens,
+                                ), n_first_dialog_messages_removed
+
+                    answer = "".join(answer_parts)
+
+                    (
+                        n_input_tokens,
+                        n_output_tokens,
+                    ) = self._count_tokens_from_messages(
+                        messages, answer, model=self.model
+                    )
 
                 answer = self._postprocess_answer(answer)
 
             except openai.error.InvalidRequestError as e:  # too many tokens
+                if not _is_context_length_error(e):
+                    raise
+
                 if len(dialog_messages) == 0:
                     raise e
                 # forget first message in dialog_messages
@@ -338,36 +541,33 @@ class ChatGPT:
 
 
     def _generate_prompt(self, message, dialog_messages, chat_mode):
-        prompt = config.chat_modes[chat_mode]["prompt_start"]
-        prompt += "\n\n"
+        parts = [config.chat_modes[chat_mode]["prompt_start"], "\n\n"]
 
         # add chat context
         if len(dialog_messages) > 0:
-            prompt += "Chat:\n"
+            parts.append("Chat:\n")
             for dialog_message in dialog_messages:
-                prompt += f"User: {dialog_message['user']}\n"
-                prompt += f"Assistant: {dialog_message['bot']}\n"
+                parts.append(f"User: {dialog_message['user']}\n")
+                parts.append(f"Assistant: {dialog_message['bot']}\n")
 
         # current message
-        prompt += f"User: {message}\n"
-        prompt += "Assistant: "
-
-        return prompt
-
-    def _encode_image(self, image_buffer: BytesIO) -> bytes:
-        return base64.b64encode(image_buffer.read()).decode("utf-8")
-
-    def _generate_prompt_messages(self, message, dialog_messages, chat_mode, image_buffer: BytesIO = None):
-        prompt = config.chat_modes[chat_mode]["prompt_start"]
-
-        #messages = [{"role": "system", "content": config.chat_modes[chat_mode]["prompt_start"]}]
-        messages = [{"role": "system", "content": prompt}] #repo commit
-
-        for dialog_message in dialog_messages:
-            messages.append({"role": "user", "content": dialog_message["user"]})
-            messages.append({"role": "assistant", "content": dialog_message["bot"]})
+        parts.append(f"User: {message}\n")
+        parts.append("Assistant: ")
+
+        return "".join(parts)
+
+    def _generate_prompt_messages(self, message, dialog_messages, chat_mode, encoded_image: str = None):
+        messages = [_SYSTEM_MSGS[chat_mode]]
+        messages.extend(
+            message_dict
+            for dialog_message in dialog_messages
+            for message_dict in (
+                {"role": "user", "content": dialog_message["user"]},
+                {"role": "assistant", "content": dialog_message["bot"]},
+            )
+        )
 
-        if image_buffer is not None:
+        if encoded_image is not None:
             messages.append(
                 {
                     "role": "user", 
@@ -378,7 +578,7 @@ class ChatGPT:
                         },
                         {
                             "type": "image",
-                            "image": self._encode_image(image_buffer),
+                            "image": encoded_image,
                         }
                     ]
                 }
@@ -390,33 +590,37 @@ class ChatGPT:
         return messages
 
     def _generate_claude_prompt(self, message, dialog_messages, chat_mode, image_buffer: BytesIO = None):
-        prompt = config.chat_modes[chat_mode]["prompt_start"]
-        combined_prompt = prompt
+        # prompt_start goes in the cacheable system block (_CLAUDE_SYSTEM_BLOCKS), not in the turn text
+        turns = []
 
         for dialog_message in dialog_messages:
-            combined_prompt += f"\n\nHuman: {dialog_message['user']}\n\nAssistant: {dialog_message['bot']}"
+            turns.append(f"Human: {dialog_message['user']}")
+            turns.append(f"Assistant: {dialog_message['bot']}")
 
+        turns.append(f"Human: {message}")
         if image_buffer is not None:
-            encoded_image = self._encode_image(image_buffer)
-            combined_prompt += f"\n\nHuman: {message}\n\nAssistant: [IMAGE: {encoded_image}]"
-        else:
-            combined_prompt += f"\n\nHuman: {message}"
+            encoded_image = encode_image(image_buffer)
+            turns.append(f"Assistant: [IMAGE: {encoded_image}]")
 
-        combined_prompt += "\n\nAssistant:"
-        return combined_prompt
+        turns.append("Assistant:")
+        return "\n\n".join(turns)
 
     def _postprocess_answer(self, answer):
-        self.logger.debug(f"Pre-processed answer: {answer}")
+        self.logger.debug("Pre-processed answer: %s", answer)
         answer = answer.strip()
-        self.logger.debug(f"Post-processed answer: {answer}")
+        self.logger.debug("Post-processed answer: %s", answer)
         return answer
 
+    def _claude_usage(self, usage):
+        # input_tokens excludes the prompt tokens read from or written to the cache
+        n_cache_read_tokens = getattr(usage, "cache_read_input_tokens", None) or 0
+        n_cache_creation_tokens = getattr(usage, "cache_creation_input_tokens", None) or 0
+        self.logger.debug("Claude cached input tokens: %s", n_cache_read_tokens)
+        return usage.input_tokens + n_cache_read_tokens + n_cache_creation_tokens, usage.output_tokens
+
     def _count_tokens_from_messages(self, messages, answer, model="gpt-4-1106-preview"):
 
-        if model.startswith("claude"):
-            encoding = tiktoken.encoding_for_model("gpt-4-turbo-2024-04-09")
-        else:
-            encoding = tiktoken.encoding_for_model(model)
+        encoding = _get_encoding(model)
 
         tokens_per_message = 3
         tokens_per_name = 1
@@ -433,49 +637,63 @@ class ChatGPT:
         else:
             raise ValueError(f"Unknown model: {model}")
 
-        # input
-        n_input_tokens = 0
+        # input: collect all texts first
+        texts = []
         for message in messages:
-            n_input_tokens += tokens_per_message
             if isinstance(message["content"], list):
                 for sub_message in message["content"]:
-                    if "type" in sub_message:
-                        if sub_message["type"] == "text":
-                            n_input_tokens += len(encoding.encode(sub_message["text"]))
-                        elif sub_message["type"] == "image_url":
-                            pass
+                    if sub_message.get("type") == "text":
+                        texts.append(sub_message["text"])
+            elif message.get("type") == "text":
+                texts.append(message["text"])
+
+        n_input_tokens = tokens_per_message * len(messages)
+
+        # dialog history repeats on every turn, so only texts not seen before are tokenized
+        uncached_texts = []
+        for text in texts:
+            n_tokens = _text_token_cache.get((encoding.name, text))
+            if n_tokens is None:
+                uncached_texts.append(text)
             else:
-                if "type" in message:
-                    if message["type"] == "text":
-                        n_input_tokens += len(encoding.encode(message["text"]))
-                    elif message["type"] == "image_url":
-                        pass
+                n_input_tokens += n_tokens
+
+        if len(uncached_texts) >= TOKEN_BATCH_MIN_TEXTS:
+            encoded_texts = encoding.encode_ordinary_batch(uncached_texts)
+        else:
+            encoded_texts = [encoding.encode_ordinary(text) for text in uncached_texts]
+
+        for text, tokens in zip(uncached_texts, encoded_texts):
+            _text_token_cache.set((encoding.name, text), len(tokens))
+            n_input_tokens += len(tokens)
 
         n_input_tokens += 2
 
         # output
-        n_output_tokens = 1 + len(encoding.encode(answer))
+        n_output_tokens = 1 + len(encoding.encode_ordinary(answer))
 
         return n_input_tokens, n_output_tokens
 
     def _count_tokens_from_prompt(self, prompt, answer, model="text-davinci-003"):
-        if model.startswith("claude"):
-            encoding = tiktoken.encoding_for_model("gpt-4-turbo-2024-04-09")
-        else:
-            encoding = tiktoken.encoding_for_model(model)
+        encoding = _get_encoding(model)
 
-        n_input_tokens = len(encoding.encode(prompt)) + 1
-        n_output_tokens = len(encoding.encode(answer))
+        n_input_tokens = len(encoding.encode_ordinary(prompt)) + 1
+        n_output_tokens = len(encoding.encode_ordinary(answer))
 
         return n_input_tokens, n_output_tokens
     
 async def transcribe_audio(audio_file) -> str:
-    r = await openai.Audio.atranscribe("whisper-1", audio_file)
+    _use_shared_openai_session()
+    # Audio, Image and Moderation in openai 0.28 do not take request_timeout (it would be sent as
+    # a request parameter), so their total time is bounded here instead
+    r = await asyncio.wait_for(openai.Audio.atranscribe("whisper-1", audio_file), OPENAI_TOTAL_TIMEOUT)
     return r["text"] or ""
 
 
 async def generate_images(prompt, model="dall-e-2", n_images=4, size="1024x1024", quality="standard"):
     """Generate images using OpenAI's specified model, including DALL-E 3."""
+    _use_shared_openai_session()
+
     #redundancy to make sure the api call isnt made wrong
     if model=="dalle-2":
         model="dall-e-2"
@@ -483,21 +701,67 @@ async def generate_images(prompt, model="dall-e-2", n_images=4, size="1024x1024"
 
     if model=="dalle-3":
         model="dall-e-3"
-        n_images=1
-    # Make the API call to generate images using the specified model
-    response = await openai.Image.acreate(
-        model=model,
-        prompt=prompt,
-        n=n_images,
-        size=size,
-        quality=quality
-    )
 
-    # Extract image URLs from the response
-    image_urls = [item.url for item in response.data]
-    return image_urls
+    # one single-image request per image, run concurrently: dall-e-3 only accepts n=1, and for
+    # dall-e-2 parallel requests come back sooner than one request generating all images in turn
+    responses = await asyncio.gather(*(
+        _create_image(model=model, prompt=prompt, size=size, quality=quality)
+        for _ in range(n_images)
+    ))
+
+    # images come back inline, so the caller does not have to download them from a temporary url
+    images = [base64.b64decode(item.b64_json) for response in responses for item in response.data]
+    return images
+
+
+async def generate_images_batch(prompts, **kwargs):
+    """Generate images for several prompts at once; returns a list of image lists in prompt order"""
+    return await asyncio.gather(*(generate_images(prompt, **kwargs) for prompt in prompts))
 
 
+_image_semaphore = None
+
+async def _create_image(**kwargs):
+    global _image_semaphore
+    if _image_semaphore is None:
+        _image_semaphore = asyncio.Semaphore(IMAGE_MAX_CONCURRENT_REQUESTS)
+
+    async with _image_semaphore:
+        return await asyncio.wait_for(
+            openai.Image.acreate(n=1, response_format="b64_json", **kwargs), OPENAI_TOTAL_TIMEOUT
+        )
+
+
+_moderation_cache = TTLCache(MODERATION_CACHE_MAX_SIZE)
+
 async def is_content_acceptable(prompt):
-    r = await openai.Moderation.acreate(input=prompt)
-    return not all(r.results[0].categories.values())
+    return (await are_contents_acceptable([prompt]))[0]
+
+
+async def are_contents_acceptable(prompts):
+    """Moderate several prompts with at most one request; returns a verdict per prompt, in order"""
+    verdicts = [None] * len(prompts)
+    unchecked = {}  # cache key -> indices of prompts with that text
+    for i, prompt in enumerate(prompts):
+        if len(prompt.strip()) < MODERATION_MIN_PROMPT_LENGTH:
+            verdicts[i] = True
+            continue
+
+        cache_key = hashlib.blake2b(prompt.encode("utf-8"), digest_size=16).digest()
+        verdicts[i] = _moderation_cache.get(cache_key)
+        if verdicts[i] is None:
+            unchecked.setdefault(cache_key, []).append(i)
+
+    if unchecked:
+        _use_shared_openai_session()
+        r = await asyncio.wait_for(
+            openai.Moderation.acreate(input=[prompts[indices[0]] for indices in unchecked.values()]),
+            OPENAI_TOTAL_TIMEOUT
+        )
+        for (cache_key, indices), result in zip(unchecked.items(), r.results):
+            is_acceptable = not result.flagged
+            _moderation_cache.set(cache_key, is_acceptable)
+            for i in indices:
+                verdicts[i] = is_acceptable
+
+    return verdicts
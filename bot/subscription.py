@@ -1,3 +1,4 @@
+import math
 from datetime import datetime, timedelta
 from enum import Enum
 
@@ -27,36 +28,39 @@ class Subscription:
         if not self.is_active():
             return False
 
-        limits = {
-            SubscriptionType.FREE: 15,
-            SubscriptionType.PRO_LITE: 1000,
-            SubscriptionType.PRO_PLUS: float('inf'),
-            SubscriptionType.PRO_PREMIUM: float('inf')
-        }
-        return self.requests_used < limits.get(self.type, 0)
+        return self.requests_used < SUBSCRIPTION_REQUEST_LIMITS.get(self.type, 0)
 
     def can_generate_image(self) -> bool:
         if not self.is_active():
             return False
 
-        limits = {
-            SubscriptionType.FREE: 3,
-            SubscriptionType.PRO_LITE: 20,
-            SubscriptionType.PRO_PLUS: float('inf'),
-            SubscriptionType.PRO_PREMIUM: float('inf')
-        }
-        return self.images_used < limits.get(self.type, 0)
+        return self.images_used < SUBSCRIPTION_IMAGE_LIMITS.get(self.type, 0)
 
     def get_max_response_length(self) -> int:
-        lengths = {
-            SubscriptionType.FREE: 2000,
-            SubscriptionType.PRO_LITE: 4000,
-            SubscriptionType.PRO_PLUS: 32000,
-            SubscriptionType.PRO_PREMIUM: 32000
-        }
-        return lengths.get(self.type, 2000)
+        return SUBSCRIPTION_RESPONSE_LENGTHS.get(self.type, 2000)
 
 
+SUBSCRIPTION_REQUEST_LIMITS = {
+    SubscriptionType.FREE: 15,
+    SubscriptionType.PRO_LITE: 1000,
+    SubscriptionType.PRO_PLUS: math.inf,
+    SubscriptionType.PRO_PREMIUM: math.inf
+}
+
+SUBSCRIPTION_IMAGE_LIMITS = {
+    SubscriptionType.FREE: 3,
+    SubscriptionType.PRO_LITE: 20,
+    SubscriptionType.PRO_PLUS: math.inf,
+    SubscriptionType.PRO_PREMIUM: math.inf
+}
+
+SUBSCRIPTION_RESPONSE_LENGTHS = {
+    SubscriptionType.FREE: 2000,
+    SubscriptionType.PRO_LITE: 4000,
+    SubscriptionType.PRO_PLUS: 32000,
+    SubscriptionType.PRO_PREMIUM: 32000
+}
+
 SUBSCRIPTION_PRICES = {
     SubscriptionType.PRO_LITE: 10,
     SubscriptionType.PRO_PLUS: 10,
@@ -0,0 +1,35 @@
+import importlib
+import sys
+import types
+from pathlib import Path
+
+import yaml
+
+ROOT_DIR = Path(__file__).parent.parent.resolve()
+
+
+def _import_openai_utils(monkeypatch):
+    # config.py needs config.yml/config.env, which only exist in a deployment;
+    # only the chat modes matter here, so they come from the shipped chat_modes.yml
+    with open(ROOT_DIR / "config" / "chat_modes.yml", 'r') as f:
+        chat_modes = yaml.safe_load(f)
+
+    fake_config = types.ModuleType("config")
+    fake_config.openai_api_key = "test"
+    fake_config.openai_api_base = None
+    fake_config.anthropic_api_key = None
+    fake_config.enable_detailed_logging = False
+    fake_config.chat_modes = chat_modes
+
+    monkeypatch.syspath_prepend(str(ROOT_DIR / "bot"))
+    monkeypatch.setitem(sys.modules, "config", fake_config)
+    monkeypatch.delitem(sys.modules, "openai_utils", raising=False)
+    return importlib.import_module("openai_utils"), chat_modes
+
+
+def test_import_with_shipped_chat_modes(monkeypatch):
+    openai_utils, chat_modes = _import_openai_utils(monkeypatch)
+
+    modes_with_prompt = {mode for mode, mode_dict in chat_modes.items() if "prompt_start" in mode_dict}
+    assert modes_with_prompt != set(chat_modes)  # artist/stenographer have no prompt_start
+    assert set(openai_utils._SYSTEM_MSGS) == modes_with_prompt